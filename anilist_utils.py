@@ -2,7 +2,9 @@
 See https://anilist.github.io/ApiV2-GraphQL-Docs/ and https://anilist.co/graphiql for help.
 """
 
-from request_utils import safe_post_request, depaginated_request
+from datetime import timedelta
+
+from request_utils import safe_post_request, depaginated_request, cache
 
 
 def get_user_id_by_name(username):
@@ -15,8 +17,11 @@ query ($username: String) {
     return safe_post_request({'query': query_user_id, 'variables': {'username': username}})['User']['id']
 
 
-def get_user_media(user_id, status='COMPLETED'):
-    """Given an AniList user ID, fetch their anime list, returning a list of media objects sorted by score (desc)."""
+@cache('.cache/user_media.json', max_age=timedelta(hours=1))
+def get_user_media_raw(user_id, status, updated_at):
+    """Return get_user_media's results. Separated from get_user_media so that the cache is keyed on updated_at (the
+    time the user's list was last updated), which is otherwise unused. This way any change to the list invalidates it.
+    """
     query = '''
 query ($userId: Int, $status: MediaListStatus, $page: Int, $perPage: Int) {
     Page (page: $page, perPage: $perPage) {
@@ -25,16 +30,41 @@ query ($userId: Int, $status: MediaListStatus, $page: Int, $perPage: Int) {
         # IMPORTANT: Always include MEDIA_ID in the sort, as the anilist API is bugged - if ties are possible,
         #            pagination can omit some results while duplicating others at the page borders.
         mediaList(userId: $userId, status: $status, sort: [SCORE_DESC, MEDIA_ID]) {
-            media {
-                id
-                title {
-                    english
-                    romaji
-                }
-            }
+            media { id }
         }
     }
 }'''
 
     return [list_entry['media'] for list_entry in depaginated_request(query=query,
                                                                       variables={'userId': user_id, 'status': status})]
+
+
+def get_user_list_updated_at(user_id):
+    """Given an AniList user ID, return the time (as a unix timestamp) at which any entry in their lists was last
+    updated, or None if their lists are empty. Note that this does not account for removed entries.
+    """
+    query = '''
+query ($userId: Int) {
+    Page (perPage: 1) {
+        mediaList(userId: $userId, sort: UPDATED_TIME_DESC) { updatedAt }
+    }
+}'''
+    list_entries = safe_post_request({'query': query, 'variables': {'userId': user_id}})['Page']['mediaList']
+
+    return list_entries[0]['updatedAt'] if list_entries else None
+
+
+_UNSET = object()  # Default for get_user_media's updated_at, since None is a valid value (empty list)
+
+
+def get_user_media(user_id, status='COMPLETED', updated_at=_UNSET):
+    """Given an AniList user ID, fetch their anime list, returning a list of media objects sorted by score (desc).
+    Only the media IDs are fetched.
+
+    Results are cached for an hour, or until the user next updates their list. Pass the result of
+    get_user_list_updated_at as updated_at when fetching multiple statuses, to avoid re-querying it for each.
+    """
+    if updated_at is _UNSET:
+        updated_at = get_user_list_updated_at(user_id)
+
+    return get_user_media_raw(user_id, status, updated_at=updated_at)
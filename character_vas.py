@@ -2,7 +2,7 @@ import argparse
 from datetime import timedelta
 import math
 
-from request_utils import safe_post_request, depaginated_request, cache
+from request_utils import query_counter, depaginated_request, cache
 from anilist_utils import get_user_id_by_name
 
 
@@ -208,7 +208,7 @@ def main():
 
     print(f"\n% main chars: {round(100 * (num_main / num_seen))}%")
 
-    print(f"\nTotal queries: {safe_post_request.total_queries} (non-user-specific data cached)")
+    print(f"\nTotal queries: {query_counter.count} (non-user-specific data cached)")
 
 
 if __name__ == '__main__':
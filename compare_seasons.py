@@ -2,8 +2,8 @@
 
 import argparse
 
-from request_utils import safe_post_request, depaginated_request
-from upcoming_sequels import get_user_id_by_name
+from request_utils import query_counter, depaginated_request
+from anilist_utils import get_user_id_by_name
 
 
 # TODO: Use MediaListCollection to get 500 entries at a time instead of 50
@@ -80,4 +80,4 @@ if __name__ == '__main__':
                          if i < len(shows) else 30 * ' '
                          for shows in seasonal_user_shows))
 
-    print(f"\nTotal queries: {safe_post_request.total_queries}")
+    print(f"\nTotal queries: {query_counter.count}")
@@ -2,7 +2,7 @@ import argparse
 from collections import Counter
 
 import staff_types
-from request_utils import safe_post_request, depaginated_request, dict_intersection
+from request_utils import query_counter, safe_post_request, depaginated_request, dict_intersection
 
 STAFF_COL_WIDTH = 20
 SHOW_COL_WIDTH = 40
@@ -415,4 +415,4 @@ if __name__ == '__main__':
         print("")
         print("No common studios/staff/VAs found!".center(total_width))
 
-    print(f"\nTotal queries: {safe_post_request.total_queries}")
+    print(f"\nTotal queries: {query_counter.count}")
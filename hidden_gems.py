@@ -3,7 +3,7 @@
 import argparse
 from typing import Optional
 
-from request_utils import safe_post_request, depaginated_request
+from request_utils import query_counter, depaginated_request
 
 
 # TODO: Allow passing a user, and use their personal scores instead of average score (to get shows *they* would consider
@@ -213,4 +213,4 @@ if __name__ == '__main__':
             title = show['title']['english'] or show['title']['romaji']
             print(f"{round(100 * show['adjustedScore']):>4} | {str(show['popularity']).rjust(len(str(args.popularity - 1)))} | {title}")
 
-    print(f"\nTotal queries: {safe_post_request.total_queries}")
+    print(f"\nTotal queries: {query_counter.count}")
@@ -1,51 +1,228 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from importlib.util import find_spec
+import math
+import random
 import requests
+from requests.adapters import HTTPAdapter
+import threading
 import time
 import json
 import atexit
 from pathlib import Path
 
+# Optionally use httpx for HTTP/2 support, which also requires the h2 package
+try:
+    import httpx
+    if find_spec('h2') is None:
+        httpx = None
+except ImportError:
+    httpx = None
+
+# Optionally use orjson for faster parsing of responses
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 
 URL = 'https://graphql.anilist.co'
 MAX_PAGE_SIZE = 50  # The anilist API's max page size
 API_MAX_REQ_PER_MIN = 90
+RATE_LIMIT_WINDOW = 60  # Seconds
+MAX_CONNECTIONS = 64  # Size of the pooled keep-alive connections to the API
+REQUEST_TIMEOUT = 60  # Seconds
+MAX_RATE_LIMIT_RETRIES = 6
+LOW_RATE_LIMIT_REMAINING = 5  # Start spacing out requests when this few are left in the current rate limit window
+
+# Errors raised for failed (e.g. 4XX) responses, whichever HTTP library is in use
+HTTP_ERRORS = (requests.HTTPError,) if httpx is None else (requests.HTTPError, httpx.HTTPStatusError)
+
+
+class _QueryCounter:
+    """Thread-safe count of queries sent to the API."""
+    __slots__ = ('count', '_lock')
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def increment(self):
+        with self._lock:
+            self.count += 1
+
+
+query_counter = _QueryCounter()  # Total queries sent so far, for reporting
+
+_session = None
+_session_lock = threading.Lock()
+
+_rate_limit_lock = threading.Lock()  # Guards the below rate limit state
+_rate_limit_wait_lock = threading.Lock()  # Held while waiting on the rate limit
+_rate_limited_until = 0  # time.monotonic() time before which no requests should be sent
+_rate_limit_remaining = API_MAX_REQ_PER_MIN  # Estimated number of requests left in the current rate limit window
+_rate_limit_window_end = 0  # Estimated time.monotonic() time at which the current rate limit window resets
+
+_inflight_requests = {}  # JSON request body: Future for its result, for each request currently being sent
+_inflight_requests_lock = threading.Lock()
+
+
+def _get_session():
+    """Return the shared HTTP session, creating it on first use.
+    Re-using one session keeps connections alive across requests, so we only pay the TCP + TLS handshake once rather
+    than once per query.
+
+    If httpx (with HTTP/2 support) is installed, it is used so that concurrent requests can all be multiplexed over a
+    single connection. Otherwise falls back to a pooled requests.Session.
+    """
+    global _session
+    with _session_lock:  # Avoid racing threads each creating a session
+        if _session is None:
+            if httpx is not None:
+                _session = httpx.Client(http2=True,
+                                        limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                                            max_keepalive_connections=MAX_CONNECTIONS))
+            else:
+                _session = requests.Session()
+                _session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONNECTIONS))
+            atexit.register(close_session)
+
+    return _session
+
+
+def close_session():
+    """Close the shared session's pooled connections, if open."""
+    global _session
+    if _session is not None:
+        _session.close()
+        _session = None
+
+
+def _wait_for_rate_limit():
+    """Block until we're clear to send another request, per the last-seen rate limit state. The wait lock is held while
+    sleeping, so that other waiting threads queue up behind this one rather than all firing at once when it ends.
+    """
+    global _rate_limit_remaining, _rate_limit_window_end
+    with _rate_limit_wait_lock:
+        delay = _rate_limited_until - time.monotonic()
+        while delay > 0:  # Re-check after sleeping, in case another 429 pushed the deadline back meanwhile
+            time.sleep(delay)
+            delay = _rate_limited_until - time.monotonic()
+
+        # If we're about to run out of requests, spread what's left over the rest of the window instead of bursting
+        # into a 429 and a ~minute wait
+        with _rate_limit_lock:
+            delay = 0
+            if time.monotonic() >= _rate_limit_window_end:  # Assume this request starts a new window
+                _rate_limit_window_end = time.monotonic() + RATE_LIMIT_WINDOW
+                _rate_limit_remaining = API_MAX_REQ_PER_MIN
+            elif _rate_limit_remaining < LOW_RATE_LIMIT_REMAINING:
+                delay = (_rate_limit_window_end - time.monotonic()) / max(_rate_limit_remaining, 1)
+            _rate_limit_remaining -= 1  # Count this request now, since other threads may send more before it returns
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _update_rate_limit(headers):
+    """Update the rate limit state from the headers of an API response."""
+    global _rate_limit_remaining, _rate_limit_window_end
+    if 'X-RateLimit-Remaining' not in headers:
+        return
+
+    with _rate_limit_lock:
+        # Concurrent responses can arrive out of order, so only ever lower the estimate; _wait_for_rate_limit resets it
+        # once the window is over
+        _rate_limit_remaining = min(_rate_limit_remaining, int(headers['X-RateLimit-Remaining']))
+        if 'X-RateLimit-Reset' in headers:  # Unix timestamp; only seems to be sent with 429s
+            _rate_limit_window_end = time.monotonic() + int(headers['X-RateLimit-Reset']) - time.time()
+
+
+def _delay_requests(delay):
+    """Hold off all requests for the given number of seconds. Return True if this pushed back the existing deadline
+    (i.e. this wasn't already covered by another thread's delay).
+    """
+    global _rate_limited_until, _rate_limit_window_end
+    with _rate_limit_lock:
+        if time.monotonic() + delay <= _rate_limited_until:
+            return False
+
+        _rate_limited_until = _rate_limit_window_end = time.monotonic() + delay  # The window resets once this passes
+        return True
 
 
 def safe_post_request(post_json, verbose=True):
     """Send a post request to the AniList API, automatically waiting and retrying if the rate limit was encountered.
     Returns the 'data' field of the response. Note that this may be None if the request found nothing (404).
+
+    Requests are also proactively slowed down when the API reports that the rate limit is about to be hit.
+
+    If an identical request is already in flight (e.g. from another thread), waits for and returns its result instead
+    of re-sending it. Note that such concurrent callers will share the same returned object.
     """
-    response = requests.post(URL, json=post_json)
+    key = json.dumps(post_json, sort_keys=True)
+    with _inflight_requests_lock:
+        future = _inflight_requests.get(key)
+        is_new_request = future is None
+        if is_new_request:
+            future = _inflight_requests[key] = Future()
 
-    # Handle rate limit
-    while response.status_code == 429:
-        if 'Retry-After' in response.headers:
-            retry_after = int(response.headers['Retry-After']) + 1
-            if verbose:
-                retry_msg = f"Rate limit encountered; waiting {retry_after} seconds..."
-                print(retry_msg, end='', flush=True)  # No trailing newline so we can overwrite this printout
+    if not is_new_request:
+        return future.result()
 
-            time.sleep(retry_after)
+    try:
+        result = _send_post_request(post_json, verbose=verbose)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _inflight_requests_lock:
+            del _inflight_requests[key]
+
+
+def _send_post_request(post_json, verbose=True):
+    """Send a post request on behalf of safe_post_request, handling the rate limit."""
+    attempts = 0
+    retry_msg = None
+    while True:
+        _wait_for_rate_limit()
+
+        # Write back over the rate limit message with whitespace
+        if retry_msg is not None:
+            print('\r' + len(retry_msg) * " ", end='\r', flush=True)  # Both '\r' here so cursor looks nice...
+            retry_msg = None
+
+        response = _get_session().post(URL, json=post_json, timeout=REQUEST_TIMEOUT)
+        _update_rate_limit(response.headers)
 
-            # Write back over the rate limit message with whitespace
-            if verbose:
-                print('\r' + len(retry_msg) * " ", end='\r', flush=True)  # Both '\r' here so cursor looks nice...
-        else:  # Retry-After should always be present, but have seen it be missing for some users; retry quickly
-            time.sleep(0.1)
-            #print(f"AniList API gave rate limit response without retry time; trying waiting {retry_after} seconds...")
+        if response.status_code != 429 or attempts >= MAX_RATE_LIMIT_RETRIES:
+            break
 
-        response = requests.post(URL, json=post_json)
+        # Handle rate limit, backing off exponentially (with jitter so threads don't retry in lockstep) if we keep
+        # hitting it. Retry-After should always be present, but have seen it be missing for some users
+        attempts += 1
+        retry_after = int(response.headers['Retry-After']) + 1 if 'Retry-After' in response.headers else 0
+        delay = max(retry_after, 2 ** (attempts - 1)) + random.uniform(0, 0.5)
 
-    safe_post_request.total_queries += 1  # We'll ignore requests that got 429'd
+        # Only the thread that set the wait reports it, rather than every thread that got 429'd
+        if _delay_requests(delay) and verbose:
+            retry_msg = f"Rate limit encountered; waiting {round(delay)} seconds..."
+            print(retry_msg, end='', flush=True)  # No trailing newline so we can overwrite this printout
+
+    if response.status_code != 429:  # We'll ignore requests that got 429'd
+        query_counter.increment()
 
     # Handle case where response isn't valid JSON.
     try:
-        response_json = response.json()
+        response_json = _json_loads(response.content)
     except:
         print(f"While sending JSON request:\n{post_json}\n\nGot unparsable response:\n{response}\n\n")
         raise
 
-    if not response.ok:
+    if response.status_code >= 400:
         if 'errors' in response_json:
             for error in response_json['errors']:
                 print(f"Error {error['status']}: {error['message']}\n")
@@ -54,48 +231,84 @@ def safe_post_request(post_json, verbose=True):
     return response_json['data']
 
 
-safe_post_request.total_queries = 0  # Spooky property-on-function
-
-
 # Note that the anilist API's lastPage field of PageInfo is currently broken and doesn't return reliable results
-def depaginated_request(query, variables, max_count=None, verbose=True):
+def depaginated_request(query, variables, max_count=None, verbose=True, lookahead=1):
     """Given a paginated query string, request every page and return a list of all the requested objects.
 
     Query must return only a single Page or paginated object subfield, and will be automatically unwrapped. page and
     perPage fields will also be automatically added to query vars.
+
+    To hide request latency on multi-page results, once a page reports that there are more pages, the next `lookahead`
+    pages are requested in the background while the current page is processed. The first page is always requested on
+    its own, so single-page results cost a single query. Multi-page results can cost up to `lookahead` wasted queries
+    past the last page; pass lookahead=0 to disable.
     """
     paginated_variables = {
         **variables,
         'perPage': MAX_PAGE_SIZE
     }
 
+    def request_page(page_num):
+        return safe_post_request({'query': query, 'variables': {**paginated_variables, 'page': page_num}},
+                                 verbose=verbose)
+
+    # If we were given a max count, don't bother speculatively requesting pages past those it should need
+    max_pages = None if max_count is None else max(math.ceil(max_count / MAX_PAGE_SIZE), 1)
+
     out_list = []
+    unwrap_path = None  # Keys to unwrap from each page's response to get to the paginated object
+    results_key = None  # Key for the non-pageInfo field of the paginated object
 
-    page_num = 1  # Note that pages are 1-indexed
-    while True:
-        paginated_variables['page'] = page_num
-        response_data = safe_post_request({'query': query, 'variables': paginated_variables}, verbose=verbose)
+    executor = ThreadPoolExecutor(max_workers=lookahead + 1)
+    page_futures = deque()
+    next_page_num = 1  # Note that pages are 1-indexed
+    cur_lookahead = 0  # Don't speculate until we know there's more than one page
+    try:
+        while True:
+            # Keep the current page and up to `cur_lookahead` following pages in flight
+            while not page_futures or (len(page_futures) <= cur_lookahead
+                                       and (max_pages is None or next_page_num <= max_pages)):
+                page_futures.append(executor.submit(request_page, next_page_num))
+                next_page_num += 1
 
-        # Blindly unwrap the returned json until we see pageInfo. This unwraps both Page objects and cases where we're
-        # querying a paginated subfield of some other object.
-        # E.g. if querying Media.staff.edges, unwraps "Media" and "staff" to get {"pageInfo":... "edges"...}
-        while 'pageInfo' not in response_data:
-            assert response_data, "Could not find pageInfo in paginated request."
-            assert len(response_data) == 1, "Cannot de-paginate query with multiple returned fields."
+            response_data = page_futures.popleft().result()
 
-            response_data = response_data[next(iter(response_data))]  # Unwrap
+            # Every page has the same shape, so re-use the keys we unwrapped on the first page, only falling back to
+            # re-discovering them if that somehow doesn't lead to a pageInfo
+            paginated_data = response_data
+            if unwrap_path is not None:
+                for key in unwrap_path:
+                    paginated_data = paginated_data.get(key) if isinstance(paginated_data, dict) else None
 
-        # Grab the non-PageInfo query result
-        assert len(response_data) == 2, "Cannot de-paginate query with multiple returned fields."
-        out_list.extend(next(v for k, v in response_data.items() if k != 'pageInfo'))
+            if not isinstance(paginated_data, dict) or 'pageInfo' not in paginated_data:
+                # Blindly unwrap the returned json until we see pageInfo. This unwraps both Page objects and cases
+                # where we're querying a paginated subfield of some other object.
+                # E.g. if querying Media.staff.edges, unwraps "Media" and "staff" to get {"pageInfo":... "edges"...}
+                paginated_data = response_data
+                unwrap_path = []
+                while 'pageInfo' not in paginated_data:
+                    assert paginated_data, "Could not find pageInfo in paginated request."
+                    assert len(paginated_data) == 1, "Cannot de-paginate query with multiple returned fields."
 
-        if max_count is not None and len(out_list) >= max_count:
-            return out_list[:max_count]
+                    unwrap_path.append(next(iter(paginated_data)))
+                    paginated_data = paginated_data[unwrap_path[-1]]  # Unwrap
 
-        if not response_data['pageInfo']['hasNextPage']:
-            return out_list
+                # Find the non-PageInfo query result
+                assert len(paginated_data) == 2, "Cannot de-paginate query with multiple returned fields."
+                results_key = next(k for k in paginated_data if k != 'pageInfo')
 
-        page_num += 1
+            out_list.extend(paginated_data[results_key])
+
+            if max_count is not None and len(out_list) >= max_count:
+                return out_list[:max_count]
+
+            if not paginated_data['pageInfo']['hasNextPage']:
+                return out_list
+
+            cur_lookahead = lookahead
+    finally:
+        # Don't wait on any speculative requests past the last page; their results are simply discarded
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 def dict_intersection(dicts):
@@ -109,16 +322,49 @@ def dict_intersection(dicts):
     return [k for k in dicts[0] if all(k in d for d in dicts[1:])]
 
 
+_cache_enabled = True
+
+
+def disable_cache():
+    """Make all functions decorated with cache() bypass their cache, always calling through (e.g. for a --no-cache
+    flag).
+    """
+    global _cache_enabled
+    _cache_enabled = False
+
+
 def cache(file_name, max_age: timedelta):
     """Memoize the given function result and cache to the given JSON file on program exit, expiring each cached result
     after a given datetime.timedelta.
+
+    The file is only loaded (and later saved) once the function is first called, so that merely importing a decorated
+    function doesn't create its cache file.
     """
-    cache = json.load(open(file_name, 'r')) if Path(file_name).is_file() else {}
-    Path(file_name).parent.mkdir(exist_ok=True)  # Create the cache dir as needed
-    atexit.register(lambda: json.dump(cache, open(file_name, 'w')))
+    cache = None
+    load_lock = threading.Lock()
+
+    def save():
+        # Drop expired results so stale entries don't accumulate in the file
+        now = datetime.now()
+        json.dump({param: result for param, result in cache.items() if datetime.fromisoformat(result[1]) >= now},
+                  open(file_name, 'w'))
+
+    def load():
+        nonlocal cache
+        with load_lock:
+            if cache is None:
+                cache = json.load(open(file_name, 'r')) if Path(file_name).is_file() else {}
+                Path(file_name).parent.mkdir(exist_ok=True)  # Create the cache dir as needed
+                atexit.register(save)
 
     def decorator(func):
         def new_func(*args, **kwargs):
+            if not _cache_enabled:
+                return func(*args, **kwargs)
+
+            if cache is None:
+                load()
+
             param = str([args, kwargs])  # Squash multiple args together
             if param not in cache or datetime.fromisoformat(cache[param][1]) < datetime.now():
                 cache[param] = [func(*args, **kwargs), (datetime.now() + max_age).isoformat()]
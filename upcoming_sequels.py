@@ -1,12 +1,34 @@
 """Given an anilist username, check what shows from their completed or planning lists have known upcoming seasons."""
 
 import argparse
-from datetime import datetime
+import atexit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import sqlite3
+import threading
 
-from request_utils import safe_post_request, depaginated_request
-from anilist_utils import get_user_id_by_name, get_user_media
+from request_utils import (HTTP_ERRORS, query_counter, safe_post_request, depaginated_request, cache,
+                           disable_cache)
+from anilist_utils import get_user_id_by_name, get_user_list_updated_at, get_user_media
 
+SEASONS = ('WINTER', 'SPRING', 'SUMMER', 'FALL')
+# Index into SEASONS of the first season to check in each month. Looks ahead a month so that a season is skipped in its
+# last month. December gives 4, which wraps around to the next year's WINTER.
+MONTH_TO_SEASON_IDX = {1: 0, 2: 0, 3: 1, 4: 1, 5: 1, 6: 2, 7: 2, 8: 2, 9: 3, 10: 3, 11: 3, 12: 4}
+MAX_WORKERS = 8  # Max number of shows to search concurrently
+MAX_RELATIONS_BATCH_SIZE = 10  # Max media to fetch relations for per query; kept small to avoid the complexity limit
+CHAINED_RELATION_TYPES = frozenset({'SEQUEL', 'PREQUEL', 'SOURCE', 'ALTERNATIVE'})  # Relations to search through
+IGNORED_TAGS = frozenset({'Crossover'})  # Don't search through media with these tags, to avoid exploding the search
+RELATIONS_DB_FILE = '.cache/relations.db'
+RELATIONS_MAX_AGE = timedelta(days=30)  # How long to trust locally stored media relations
+# Only store relations of media that finished at least this long ago; newer media often get relations added late
+RELATIONS_MIN_FINISHED_AGE = timedelta(days=365)
 
+
+@cache('.cache/season_shows.json', max_age=timedelta(days=1))  # Seasonal catalogs change often; cache briefly
 def get_season_shows(season: str, season_year: int) -> list:
     """Given a season (WINTER, SPRING, SUMMER, FALL) and year, return a list of shows from that season."""
     query = '''
@@ -41,55 +63,200 @@ def fuzzy_date_greater_or_equal_to(fuzzy_date, date: datetime):
     return True
 
 
-def get_related_media(show_id):
-    """Given a media ID, return a generator of IDs for all airing or future anime that are direct or indirect relations of it.
+_relations_cache = {}  # Media ID: list of its relation edges as (relation type, related media ID, has ignored tag)
+_related_media_cache = {}  # Media ID: tuple of all media IDs get_related_media yielded for it, once fully searched
+
 
-    Also return their airing season and relation type.
+_relations_db = None
+_relations_db_lock = threading.Lock()
+_refresh_relations = False  # If set, re-fetch stored relations instead of using them
 
-    Optionally provide a set of media IDs to ignore (e.g. also going to be searched) to cut query count.
+
+def _get_relations_db():
+    """Return a connection to the local SQLite store of media relations, creating it as needed. Should only be used
+    while holding _relations_db_lock.
     """
-    query = '''
-query ($mediaId: Int) {
-    Media(id: $mediaId) {
+    global _relations_db
+    if _relations_db is None:
+        Path(RELATIONS_DB_FILE).parent.mkdir(exist_ok=True)  # Create the cache dir as needed
+        _relations_db = sqlite3.connect(RELATIONS_DB_FILE, check_same_thread=False)  # We do our own locking
+        _relations_db.executescript('''
+CREATE TABLE IF NOT EXISTS edge (src INT, dst INT, rel TEXT, ignored INT, PRIMARY KEY (src, dst));
+CREATE TABLE IF NOT EXISTS fetched (id INT PRIMARY KEY, ts INT);  -- When each src's edges were last fetched
+''')
+        atexit.register(_relations_db.close)
+
+    return _relations_db
+
+
+def _load_stored_relations(media_ids):
+    """Given a list of media IDs, return a dict of media ID: relation edges, for those media whose relations were
+    stored by _store_relations less than RELATIONS_MAX_AGE ago.
+    """
+    min_timestamp = int((datetime.now() - RELATIONS_MAX_AGE).timestamp())
+    with _relations_db_lock:
+        db = _get_relations_db()
+        relations = {media_id: [] for (media_id,) in db.execute(
+            f"SELECT id FROM fetched WHERE ts >= ? AND id IN ({', '.join('?' * len(media_ids))})",
+            (min_timestamp, *media_ids))}
+
+        # Ordering by rowid preserves the original edge order
+        for src, dst, rel, ignored in db.execute(
+                f"SELECT src, dst, rel, ignored FROM edge WHERE src IN ({', '.join('?' * len(relations))})"
+                " ORDER BY rowid", tuple(relations)):
+            relations[src].append((rel, dst, bool(ignored)))
+
+    return relations
+
+
+def _store_relations(relations):
+    """Given a dict of media ID: relation edges, store them in the local relations DB, replacing any old edges."""
+    timestamp = int(datetime.now().timestamp())
+    with _relations_db_lock:
+        db = _get_relations_db()
+        with db:  # Commit all at once
+            db.executemany("DELETE FROM edge WHERE src = ?", ((media_id,) for media_id in relations))
+            db.executemany("INSERT OR REPLACE INTO edge VALUES (?, ?, ?, ?)",
+                           ((src, dst, rel, ignored)
+                            for src, edges in relations.items() for rel, dst, ignored in edges))
+            db.executemany("INSERT OR REPLACE INTO fetched VALUES (?, ?)",
+                           ((media_id, timestamp) for media_id in relations))
+
+
+def _is_long_finished(media):
+    """Given a Media object with status and endDate, return True if it finished at least RELATIONS_MIN_FINISHED_AGE
+    ago, such that its relations are unlikely to still be changing.
+    """
+    end_date = media['endDate']
+    if media['status'] not in ('FINISHED', 'CANCELLED') or end_date['year'] is None:
+        return False
+
+    # Assume the latest possible date if only partially known
+    return (datetime(year=end_date['year'], month=end_date['month'] or 12, day=end_date['day'] or 28)
+            <= datetime.now() - RELATIONS_MIN_FINISHED_AGE)
+
+
+def _is_query_complexity_error(error):
+    """Given an HTTP error raised by safe_post_request, return True if it looks like the query was rejected for being
+    too complex (as opposed to e.g. the rate limit, a server error, or an invalid query, which retrying as more queries
+    won't help).
+    """
+    try:
+        errors = error.response.json().get('errors', [])
+    except ValueError:  # Unparsable response
+        return False
+
+    return any('complexity' in str(e.get('message', '')).lower() for e in errors)
+
+
+def _fetch_media_relations(media_ids):
+    """Given a list of media IDs, fetch all their relation edges in a single query by aliasing one Media field per ID.
+    Return a dict of media ID: (relation edges, is long finished), with edges as
+    (relation type, related media ID, has ignored tag) tuples.
+    """
+    relations_fields = '''
+        status  # Grabbed along with endDate so we know whose relations are safe to store long-term
+        endDate { year month day }
         relations {  # Has pageInfo but doesn't accept page args
             edges {
                 relationType
                 node {  # Media
                     id
-                    title {
-                        english
-                        romaji
-                    }
-                    type
-                    format
-                    tags {
-                        name  # Grabbed so we can ignore crossovers to help avoid exploding the search
-                    }
+                    # Grabbed so we can ignore crossovers to help avoid exploding the search. Unfortunately the API
+                    # doesn't support filtering these to only the tags we care about.
+                    tags { name }
                 }
             }
-        }
-    }
-}'''
-    queue = {show_id}
+        }'''
+    query = (f"query ({', '.join(f'$id{i}: Int' for i in range(len(media_ids)))}) {{\n"
+             + ''.join(f'    m{i}: Media(id: $id{i}) {{{relations_fields}\n    }}\n' for i in range(len(media_ids)))
+             + '}')
+
+    try:
+        response_data = safe_post_request({'query': query,
+                                           'variables': {f'id{i}': media_id for i, media_id in enumerate(media_ids)}})
+    except HTTP_ERRORS as e:
+        if len(media_ids) == 1 or not _is_query_complexity_error(e):
+            raise
+
+        # If the batch went over the API's query complexity limit, fall back to querying one at a time
+        return {media_id: _fetch_media_relations([media_id])[media_id] for media_id in media_ids}
+
+    return {media_id: ([(edge['relationType'], edge['node']['id'],
+                         not IGNORED_TAGS.isdisjoint(tag['name'] for tag in edge['node']['tags']))
+                        for edge in response_data[f'm{i}']['relations']['edges']],
+                       _is_long_finished(response_data[f'm{i}']))
+            for i, media_id in enumerate(media_ids)}
+
+
+def get_media_relations(media_ids):
+    """Given an iterable of media IDs, return a dict of media ID: relation edges, as
+    (relation type, related media ID, has ignored tag) tuples.
+    Relations are fetched in batches of up to MAX_RELATIONS_BATCH_SIZE media per query.
+
+    Memoized, since the same franchises come up repeatedly across seasons and relation searches. Relations of
+    long-finished media basically never change, so those are also stored locally across runs, for up to
+    RELATIONS_MAX_AGE. Newer media (e.g. the upcoming shows being searched from) often have their relations filled in
+    late, so they're always re-fetched on the next run.
+    """
+    uncached_media_ids = [media_id for media_id in dict.fromkeys(media_ids) if media_id not in _relations_cache]
+    if uncached_media_ids and not _refresh_relations:
+        _relations_cache.update(_load_stored_relations(uncached_media_ids))
+        uncached_media_ids = [media_id for media_id in uncached_media_ids if media_id not in _relations_cache]
+
+    for i in range(0, len(uncached_media_ids), MAX_RELATIONS_BATCH_SIZE):
+        fetched = _fetch_media_relations(uncached_media_ids[i:i + MAX_RELATIONS_BATCH_SIZE])
+        # Empty relations are also likely to just not have been filled in yet, so don't store those either
+        _store_relations({media_id: relations for media_id, (relations, is_long_finished) in fetched.items()
+                          if relations and is_long_finished})
+        _relations_cache.update((media_id, relations) for media_id, (relations, _) in fetched.items())
+
+    return {media_id: _relations_cache[media_id] for media_id in media_ids}
+
+
+def get_related_media(show_id):
+    """Given a media ID, return a generator of IDs for all airing or future anime that are direct or indirect relations of it.
+
+    Results of complete searches are memoized, and re-used to skip re-searching the same part of the relation graph.
+    """
+    if show_id in _related_media_cache:
+        yield from _related_media_cache[show_id]
+        return
+
+    queue = deque([show_id])  # Searched breadth-first, so results come out in a consistent order
     related_show_ids = {show_id}  # Including itself to start avoids special-casing
+    related_show_ids_in_order = []
     while queue:
-        cur_show_id = queue.pop()
-        relations = safe_post_request({'query': query,
-                                       'variables': {'mediaId': cur_show_id}})['Media']['relations']['edges']
-        for relation in relations:
-            show = relation['node']
-            # Manga don't need to be included in the output and ignoring them trims our search queries way down
-            if show['id'] not in related_show_ids:
-                related_show_ids.add(show['id'])
-                if show['id'] != show_id:
-                    yield show
+        # Grab the relations of a batch of queued shows at once, to cut down on query count
+        batch_relations = get_media_relations([queue.popleft()
+                                               for _ in range(min(len(queue), MAX_RELATIONS_BATCH_SIZE))])
+        for relation_type, related_id, has_ignored_tag in (relation
+                                                           for relations in batch_relations.values()
+                                                           for relation in relations):
+            if related_id not in related_show_ids:
+                related_show_ids.add(related_id)
+                if related_id != show_id:
+                    related_show_ids_in_order.append(related_id)
+                    yield related_id
 
                 # Only chain through a few relation types to keep the search small
-                if (relation['relationType'] not in {'SEQUEL', 'PREQUEL', 'SOURCE', 'ALTERNATIVE'}
-                        or any(tag['name'] == 'Crossover' for tag in show['tags'])):
+                if relation_type not in CHAINED_RELATION_TYPES or has_ignored_tag:
+                    continue
+
+                # If this show's relations were already fully searched, anything it reaches is also reachable from
+                # here, so take its results instead of re-searching them
+                if related_id in _related_media_cache:
+                    for related_show_id in _related_media_cache[related_id]:
+                        if related_show_id not in related_show_ids:
+                            related_show_ids.add(related_show_id)
+                            related_show_ids_in_order.append(related_show_id)
+                            yield related_show_id
                     continue
 
-                queue.add(show['id'])
+                queue.append(related_id)  # Only reached the first time a show is seen, so none is fetched twice
+
+    # Only reached if the caller consumed the whole generator, so the result is complete
+    _related_media_cache[show_id] = tuple(related_show_ids_in_order)
 
 
 if __name__ == '__main__':
@@ -102,32 +269,70 @@ if __name__ == '__main__':
                         help="Check only for sequels of shows in the user's planning list.")
     parser.add_argument('-c', '--completed', action='store_true',
                         help="Check only for sequels of shows in the user's completed list.")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Ignore cached results and fetch everything from AniList.")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Re-fetch media relations instead of using the locally stored ones, updating the store.\n"
+                             "Otherwise relations are re-fetched every 30 days. Implied by --no-cache.")
     args = parser.parse_args()
 
+    if args.no_cache:
+        disable_cache()
+    _refresh_relations = args.refresh or args.no_cache
+
     user_id = get_user_id_by_name(args.username)
 
-    # Fetch the user's relevant media lists (anime or manga)
-    user_media_ids_by_status = {status: set(media['id'] for media in get_user_media(user_id, status))
-                                for status in ('COMPLETED', 'PLANNING', 'CURRENT')}
-    user_media_ids = set().union(*user_media_ids_by_status.values())
+    # Fetch the user's relevant media lists (anime or manga). These are independent so fetch them concurrently
+    statuses = ('COMPLETED', 'PLANNING', 'CURRENT')
+    # Shared by all three lists' cache checks. Only used as a cache key, so skip querying it if not caching
+    updated_at = None if args.no_cache else get_user_list_updated_at(user_id)
+    with ThreadPoolExecutor(max_workers=len(statuses)) as executor:
+        user_medias = executor.map(lambda status: get_user_media(user_id, status, updated_at=updated_at), statuses)
+        user_media_ids_by_status = {status: {media['id'] for media in user_media}
+                                    for status, user_media in zip(statuses, user_medias)}
+    user_media_ids = frozenset().union(*user_media_ids_by_status.values())  # Read-only from here on
 
     # Search four seasons, including the current season unless it's in its last month
-    cur_date = datetime.utcnow()
-    for i in range(4):
-        season_idx = cur_date.month // 3 + i  # cur month is 1-indexed, so we're looking ahead a month as desired
-        season = ['WINTER', 'SPRING', 'SUMMER', 'FALL'][season_idx % 4]
-        year = cur_date.year + season_idx // 4
+    cur_date = datetime.now(timezone.utc)
+    cur_season_idx = MONTH_TO_SEASON_IDX[cur_date.month]
+    seasons = [(SEASONS[(cur_season_idx + i) % 4], cur_date.year + (cur_season_idx + i) // 4) for i in range(4)]
+
+    def has_related_user_media(show):
+        """Check whether any of the given show's relations are in the user's lists."""
+        # Explicitly close the search on the first match rather than relying on garbage collection to stop it
+        with closing(get_related_media(show['id'])) as related_media_ids:
+            return any(related_media_id in user_media_ids for related_media_id in related_media_ids)
+
+    # The shows' searches are independent, so run them concurrently. Worker count is capped to go easy on the rate limit
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        try:
+            # Queue up every season's show list fetch first, so that later seasons are fetched while earlier seasons'
+            # shows are being searched
+            season_shows_futures = [executor.submit(get_season_shows, season, year) for season, year in seasons]
+
+            for i, ((season, year), season_shows_future) in enumerate(zip(seasons, season_shows_futures)):
+                if i != 0:
+                    print("")
+                print(f"{season} {year}")
+                print("=" * 40)
 
-        if i != 0:
-            print("")
-        print(f"{season} {year}")
-        print("=" * 40)
+                season_shows = season_shows_future.result()
 
-        season_shows = get_season_shows(season=season, season_year=year)
+                # Each show's search would otherwise start by fetching just that show's relations alone, so fetch all of
+                # the season's shows' relations up-front, in batches (concurrently)
+                season_show_ids = [show['id'] for show in season_shows]
+                list(executor.map(get_media_relations, (season_show_ids[j:j + MAX_RELATIONS_BATCH_SIZE]
+                                                        for j in range(0, len(season_show_ids),
+                                                                       MAX_RELATIONS_BATCH_SIZE))))
 
-        # Search each of the shows' relations for a show in the user's list
-        for show in season_shows:
-            if any(related_media['id'] in user_media_ids for related_media in get_related_media(show['id'])):
-                print(show['title']['english'] or show['title']['romaji'])
+                # Search each of the shows' relations for a show in the user's list. map preserves the input order
+                for show, has_related in zip(season_shows, executor.map(has_related_user_media, season_shows)):
+                    if has_related:
+                        print(show['title']['english'] or show['title']['romaji'])
+        except BaseException:  # Including KeyboardInterrupt
+            # Cancel the queued-up searches so they don't run before we exit. Note that any already-running searches are
+            # still waited on (including any rate limit waits), as Python joins the worker threads on exit regardless
+            executor.shutdown(cancel_futures=True)
+            raise
 
-    print(f"\nTotal queries: {safe_post_request.total_queries}")
+    print(f"\nTotal queries: {query_counter.count}")